@@ -6,6 +6,7 @@ import datetime
 import json
 import operator
 import paho.mqtt.client as mqtt
+import signal
 import struct
 import numpy as np
 
@@ -13,6 +14,8 @@ from gi.repository import GLib, GObject, Gst, GstBase
 from PIL import Image
 
 from common import avg_fps_counter, SVG
+from profiling import DEFAULT_WINDOW, Profiler
+from shared_state import DEFAULT_PATH, MAX_SLOTS, StateWriter
 from pycoral.adapters.common import input_size
 from pycoral.adapters.detect import get_objects
 from pycoral.utils.dataset import read_label_file
@@ -22,15 +25,21 @@ from pycoral.utils.edgetpu import run_inference
 TOPIC = "becherlager"
 TOPIC_INT = "cupholder"
 TOPIC_COUNT = "cupholder_count"
+TOPIC_PROFILE = "cupholder_profile"
 DATA_LAST_WILL = bytearray(struct.pack("i", -1))
 BROKER_ADRESS = "172.19.12.128"
 PORT = 1883
 QOS = 1
+MAX_QUEUED_MESSAGES = 60
 CAM_W, CAM_H = 640, 480
 DEFAULT_MODEL_DIR = "models"
 DEFAULT_MODEL = "cinito_vision_edgetpu.tflite"
 DEFAULT_LABELS = "cinito_labels.txt"
 FILE_PATH = "/home/mendel/cinito-vision/resources/cup_positions.json"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+# Whether results are currently being dropped, to log each outage once.
+_publish_dropping = False
 
 
 def generate_svg(src_size, inference_box, objs, labels, text_lines):
@@ -59,6 +68,33 @@ def generate_svg(src_size, inference_box, objs, labels, text_lines):
     return svg.finish()
 
 
+def list_images(folder):
+    """Returns the paths of the images in folder, sorted by name."""
+    return sorted(
+        os.path.join(folder, name)
+        for name in os.listdir(folder)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def letterbox(image, size, out=None):
+    """
+    Scales a PIL image to fit size and centres it on a black canvas, like the
+    videobox of the headless pipeline. Writes into out if given and returns
+    the RGB array together with the inference box for generate_svg.
+    """
+    w, h = size
+    scale = min(w / image.width, h / image.height)
+    scaled_w, scaled_h = int(image.width * scale), int(image.height * scale)
+    left, top = (w - scaled_w) // 2, (h - scaled_h) // 2
+    if out is None:
+        out = np.empty((h, w, 3), dtype=np.uint8)
+    out.fill(0)
+    resized = image.convert("RGB").resize((scaled_w, scaled_h))
+    out[top : top + scaled_h, left : left + scaled_w] = np.asarray(resized)
+    return out, (left, top, scaled_w, scaled_h)
+
+
 def center_inside(cup, basket):
     """
     Cup is the list with x1, y1, x2 and y2 for that cup
@@ -135,10 +171,10 @@ def check_cup_bbox(cup_bbox, basket):
     return positions
 
 
-def get_reference_positions(args):
+def get_reference_positions(args, path=FILE_PATH):
     try:
-        print("Loading reference positions {}".format(FILE_PATH))
-        f = open(FILE_PATH)
+        print("Loading reference positions {}".format(path))
+        f = open(path)
         data = json.load(f)
         reference_positions = json.loads(data)
         cup_bbox = []
@@ -154,7 +190,11 @@ def get_reference_positions(args):
         return None, True
 
 
-def get_next_cup_position(objs, cup_bbox):
+def get_cup_positions(objs, cup_bbox):
+    """
+    Returns the reference slot of every cup in the basket (-1 if it is in no
+    slot) and the number of cups.
+    """
     cups = []
     basket = []
     for obj in objs:
@@ -174,19 +214,60 @@ def get_next_cup_position(objs, cup_bbox):
         for cup in cup_list:
             pos = center_inside(cup, cup_bbox)
             pos_list.append(pos)
-        positive_values = [x for x in pos_list if x >= 0]
-        if len(positive_values) > 0:
-            return min(positive_values), len(cups)
-        else:
-            return -1, len(cups)
+        return pos_list, len(cups)
     else:
-        return -1, len(cups)
+        return [], len(cups)
+
+
+def next_cup_position(pos_list):
+    positive_values = [x for x in pos_list if x >= 0]
+    if len(positive_values) > 0:
+        return min(positive_values)
+    else:
+        return -1
+
+
+def get_next_cup_position(objs, cup_bbox):
+    pos_list, cups_in_basket = get_cup_positions(objs, cup_bbox)
+    return next_cup_position(pos_list), cups_in_basket
+
+
+def publish_result(client, position, count, bounded=False):
+    """
+    In bounded mode nothing is queued while the broker is unreachable: only
+    the latest occupancy matters, and queued results would be replayed as
+    stale state after the reconnect.
+    """
+    global _publish_dropping
+    dropped = bounded and not client.is_connected()
+    if not dropped:
+        DATA = struct.pack("i", position)
+        DATA = bytearray(DATA)
+        infos = [
+            client.publish(TOPIC, DATA, qos=QOS),
+            client.publish(TOPIC_INT, position, qos=QOS),
+            client.publish(TOPIC_COUNT, count, qos=QOS),
+        ]
+        dropped = any(info.rc == mqtt.MQTT_ERR_QUEUE_SIZE for info in infos)
+
+    if dropped != _publish_dropping:
+        _publish_dropping = dropped
+        if dropped:
+            print("MQTT broker unreachable, dropping results until reconnect")
+        else:
+            print("Publishing results again")
+
+
+def limit_queues(client):
+    # paho buffers every QoS 1 message while the broker is unreachable.
+    client.max_queued_messages_set(MAX_QUEUED_MESSAGES)
 
 
 # Callback functions for connection and message events
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("Connected to MQTT broker")
+        client.subscribe(TOPIC_PROFILE, qos=QOS)
     else:
         print("Connection failed")
 
@@ -203,6 +284,26 @@ def on_disconnect(client, userdata, rc):
                 time.sleep(5)
 
 
+def on_profile_message(client, profiler, message):
+    """
+    Empty payload toggles profiling, a number starts a window of that many
+    seconds and a number <= 0 stops the running window.
+    """
+    payload = message.payload.decode("utf-8", "replace").strip()
+    if not payload:
+        profiler.toggle()
+        return
+    try:
+        window = float(payload)
+    except ValueError:
+        print("Invalid profiling command: {}".format(payload))
+        return
+    if window > 0:
+        profiler.start(window)
+    else:
+        profiler.stop()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -239,6 +340,27 @@ def main():
         default=False,
         help="initialises the reference positions of the individual cups",
     )
+    parser.add_argument(
+        "--profile_dir",
+        default="/tmp",
+        help="directory for collapsed-stack profiles (SIGUSR1 or MQTT to start)",
+    )
+    parser.add_argument(
+        "--profile_window",
+        type=float,
+        default=DEFAULT_WINDOW,
+        help="default profiling window in seconds",
+    )
+    parser.add_argument(
+        "--state_path",
+        default=DEFAULT_PATH,
+        help="shared-memory file with the latest result for local readers, empty to disable",
+    )
+    parser.add_argument(
+        "--bounded_memory",
+        action="store_true",
+        help="drop results while the broker is unreachable and cap the queues",
+    )
     args = parser.parse_args()
 
     print("Loading {} with {} labels.".format(args.model, args.labels))
@@ -251,21 +373,44 @@ def main():
 
     cup_bbox, args.init = get_reference_positions(args)
 
+    profiler = Profiler(args.profile_dir, args.profile_window)
+
+    state_writer = None
+    if args.state_path:
+        try:
+            num_slots = min(len(cup_bbox or []), MAX_SLOTS)
+            state_writer = StateWriter(args.state_path, num_slots)
+        except OSError as e:
+            print("Shared-memory state disabled: {}".format(e))
+
+    def on_sigusr1():
+        profiler.toggle()
+        return GLib.SOURCE_CONTINUE
+
+    # The main thread sits in Gtk.main(), so let GLib dispatch the signal.
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, on_sigusr1)
+
     # Create a MQTT client
-    client = mqtt.Client()
+    client = mqtt.Client(userdata=profiler)
 
     # Set up the callback functions
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
+    client.message_callback_add(TOPIC_PROFILE, on_profile_message)
+
+    if args.bounded_memory:
+        limit_queues(client)
     
     client.will_set(TOPIC, payload=DATA_LAST_WILL, qos=QOS, retain=True)
     client.connect(BROKER_ADRESS, PORT)
 
     def user_callback(input_tensor, src_size, inference_box):
         start_time = time.monotonic()
-        run_inference(interpreter, input_tensor)
+        with profiler.section("run_inference"):
+            run_inference(interpreter, input_tensor)
         # For larger input image sizes, use the edgetpu.classification.engine for better performance
-        objs = get_objects(interpreter, args.threshold)[: args.top_k]
+        with profiler.section("get_objects"):
+            objs = get_objects(interpreter, args.threshold)[: args.top_k]
         end_time = time.monotonic()
         text_lines = [
             "Inference: {:.2f} ms".format((end_time - start_time) * 1000),
@@ -304,14 +449,19 @@ def main():
 
         # cup_bbox, args.init = get_reference_positions(args)
 
-        minimum_positive, cups_in_basket = get_next_cup_position(objs, cup_bbox)
+        with profiler.section("slot_assignment"):
+            positions, cups_in_basket = get_cup_positions(objs, cup_bbox)
+            minimum_positive = next_cup_position(positions)
         # print("Next position: ", minimum_positive)
 
-        DATA = struct.pack("i", minimum_positive)
-        DATA = bytearray(DATA)
-        client.publish(TOPIC, DATA, qos=QOS)
-        client.publish(TOPIC_INT, minimum_positive, qos=QOS)
-        client.publish(TOPIC_COUNT, cups_in_basket, qos=QOS)
+        if state_writer:
+            with profiler.section("shared_state"):
+                state_writer.write(minimum_positive, cups_in_basket, positions)
+
+        with profiler.section("publish"):
+            publish_result(
+                client, minimum_positive, cups_in_basket, args.bounded_memory
+            )
 
         # # Extract the raw data from the buffer
         # buffer_size = input_tensor.get_size()
@@ -331,7 +481,8 @@ def main():
         # image = Image.fromarray(array)
 
         time.sleep(5)
-        return generate_svg(src_size, inference_box, objs, labels, text_lines)
+        with profiler.section("generate_svg"):
+            return generate_svg(src_size, inference_box, objs, labels, text_lines)
 
     client.loop_start()
     result = gstreamer.run_pipeline(
@@ -341,8 +492,12 @@ def main():
         videosrc=args.videosrc,
         videofmt=args.videofmt,
         headless=True,
+        profiler=profiler,
+        bounded=args.bounded_memory,
     )
     client.loop_stop()
+    if state_writer:
+        state_writer.close()
 
 
 if __name__ == "__main__":
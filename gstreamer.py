@@ -18,6 +18,8 @@ import gi
 
 from PIL import Image
 
+from profiling import Profiler
+
 gi.require_version("Gst", "1.0")
 gi.require_version("GstBase", "1.0")
 gi.require_version("Gtk", "3.0")
@@ -27,8 +29,9 @@ Gst.init(None)
 
 
 class GstPipeline:
-    def __init__(self, pipeline, user_function, src_size):
+    def __init__(self, pipeline, user_function, src_size, profiler=None):
         self.user_function = user_function
+        self.profiler = profiler or Profiler(None)
         self.running = False
         self.gstsample = None
         self.sink_size = None
@@ -74,6 +77,7 @@ class GstPipeline:
             self.running = False
             self.condition.notify_all()
         worker.join()
+        self.profiler.finish()
 
     def on_bus_message(self, bus, message):
         t = message.type
@@ -114,20 +118,13 @@ class GstPipeline:
                     glbox.get_property("height"),
                 )
             else:
-                self.box = (
-                    -box.get_property("left"),
-                    -box.get_property("top"),
-                    self.sink_size[0]
-                    + box.get_property("left")
-                    + box.get_property("right"),
-                    self.sink_size[1]
-                    + box.get_property("top")
-                    + box.get_property("bottom"),
-                )
+                self.box = get_videobox(box, self.sink_size)
         return self.box
 
     def inference_loop(self):
+        profiler = self.profiler
         while True:
+            profiler.tick()
             with self.condition:
                 while not self.gstsample and self.running:
                     self.condition.wait()
@@ -153,14 +150,17 @@ class GstPipeline:
             #     img.close()
             #     gstbuffer.unmap(mapinfo)
 
-            svg = self.user_function(gstbuffer, self.src_size, self.get_box())
-            if svg:
-                if self.overlay:
-                    self.overlay.set_property("data", svg)
-                if self.gloverlay:
-                    self.gloverlay.emit("set-svg", svg, gstbuffer.pts)
-                if self.overlaysink:
-                    self.overlaysink.set_property("svg", svg)
+            with profiler.section("inference_loop"):
+                with profiler.section("user_callback"):
+                    svg = self.user_function(gstbuffer, self.src_size, self.get_box())
+                if svg:
+                    with profiler.section("set_overlay"):
+                        if self.overlay:
+                            self.overlay.set_property("data", svg)
+                        if self.gloverlay:
+                            self.gloverlay.emit("set-svg", svg, gstbuffer.pts)
+                        if self.overlaysink:
+                            self.overlaysink.set_property("svg", svg)
 
     def setup_window(self):
         # Only set up our own window if we have Coral overlay sink in the pipeline.
@@ -227,6 +227,115 @@ class GstPipeline:
         bus.set_sync_handler(on_bus_message_sync, self.overlaysink)
 
 
+def get_videobox(box, sink_size):
+    return (
+        -box.get_property("left"),
+        -box.get_property("top"),
+        sink_size[0] + box.get_property("left") + box.get_property("right"),
+        sink_size[1] + box.get_property("top") + box.get_property("bottom"),
+    )
+
+
+def get_scale_caps(src_size, appsink_size):
+    scale = min(appsink_size[0] / src_size[0], appsink_size[1] / src_size[1])
+    scale = tuple(int(x * scale) for x in src_size)
+    return "video/x-raw,width={width},height={height}".format(
+        width=scale[0], height=scale[1]
+    )
+
+
+def get_queue(bounded):
+    # Plain queues default to 200 buffers / 10 MB, bounded mode keeps two buffers.
+    if bounded:
+        return "queue max-size-buffers=2 max-size-bytes=0 max-size-time=0"
+    return "queue"
+
+
+def get_filesrc(videosrc):
+    demux = "avidemux" if videosrc.endswith("avi") else "qtdemux"
+    return """filesrc location=%s ! %s name=demux  demux.video_0
+                    ! {queue} ! decodebin""" % (
+        videosrc,
+        demux,
+    )
+
+
+def get_video_duration(videosrc):
+    """Returns the duration of a video file in nanoseconds, None if unknown."""
+    gi.require_version("GstPbutils", "1.0")
+    from gi.repository import GstPbutils
+
+    discoverer = GstPbutils.Discoverer.new(10 * Gst.SECOND)
+    info = discoverer.discover_uri(Gst.filename_to_uri(videosrc))
+    duration = info.get_duration()
+    if duration in (0, Gst.CLOCK_TIME_NONE):
+        return None
+    return duration
+
+
+def decode_frames(
+    videosrc, src_size, appsink_size, start=None, stop=None, bounded=False
+):
+    """
+    Decodes a video file with the filesrc pipeline as fast as possible: no
+    videorate, no leaky queues and an appsink that neither syncs nor drops.
+    start and stop (nanoseconds) restrict decoding to a segment, bounded
+    caps the queue like the --bounded_memory pipeline.
+    Yields (pts, Gst.Buffer, inference box) for every frame.
+    """
+    # Single-threaded conversion, callers run one decoder per core.
+    pipeline = (
+        get_filesrc(videosrc)
+        + """ ! videoconvert ! videoscale ! {src_caps}
+        ! videoconvert ! videoscale ! {scale_caps} ! videobox name=box autocrop=true
+        ! {sink_caps} ! appsink name=appsink sync=false max-buffers=4
+        """
+    ).format(
+        queue=get_queue(bounded),
+        src_caps="video/x-raw,width={},height={}".format(*src_size),
+        scale_caps=get_scale_caps(src_size, appsink_size),
+        sink_caps="video/x-raw,format=RGB,width={},height={}".format(*appsink_size),
+    )
+    pipeline = Gst.parse_launch(pipeline)
+    appsink = pipeline.get_by_name("appsink")
+    box = None
+    try:
+        if pipeline.set_state(Gst.State.PAUSED) == Gst.StateChangeReturn.FAILURE:
+            raise RuntimeError("Could not open {}".format(videosrc))
+        pipeline.get_state(Gst.CLOCK_TIME_NONE)
+        if start is not None or stop is not None:
+            pipeline.seek(
+                1.0,
+                Gst.Format.TIME,
+                Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+                Gst.SeekType.SET,
+                start or 0,
+                Gst.SeekType.NONE if stop is None else Gst.SeekType.SET,
+                -1 if stop is None else stop,
+            )
+        pipeline.set_state(Gst.State.PLAYING)
+        bus = pipeline.get_bus()
+        while True:
+            sample = appsink.emit("try-pull-sample", Gst.SECOND)
+            if sample is None:
+                # Timeout or EOS. Errors that never reach the appsink as EOS
+                # are only visible on the bus.
+                message = bus.pop_filtered(Gst.MessageType.ERROR)
+                if message:
+                    err, debug = message.parse_error()
+                    raise RuntimeError("{}: {}: {}".format(videosrc, err, debug))
+                # is_eos() needs GstApp, the "eos" property works on any sink.
+                if appsink.get_property("eos"):
+                    break
+                continue
+            if box is None:
+                box = get_videobox(pipeline.get_by_name("box"), appsink_size)
+            gstbuffer = sample.get_buffer()
+            yield gstbuffer.pts, gstbuffer, box
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+
+
 def get_dev_board_model():
     try:
         model = open("/sys/firmware/devicetree/base/model").read().lower()
@@ -246,6 +355,8 @@ def run_pipeline(
     videosrc="/dev/video1",
     videofmt="raw",
     headless=False,
+    profiler=None,
+    bounded=False,
 ):
     if videofmt == "h264":
         SRC_CAPS = "video/x-h264,width={width},height={height},framerate=30/1"
@@ -260,32 +371,23 @@ def run_pipeline(
     elif videosrc.startswith("rtsp"):
         PIPELINE = "rtspsrc location=%s" % videosrc
     else:
-        demux = "avidemux" if videosrc.endswith("avi") else "qtdemux"
-        PIPELINE = """filesrc location=%s ! %s name=demux  demux.video_0
-                    ! queue ! decodebin  ! videorate
+        PIPELINE = get_filesrc(videosrc) + """  ! videorate
                     ! videoconvert n-threads=4 ! videoscale n-threads=4
-                    ! {src_caps} ! {leaky_q} """ % (
-            videosrc,
-            demux,
-        )
+                    ! {src_caps} ! {leaky_q} """
 
     coral = get_dev_board_model()
     if headless:
-        scale = min(appsink_size[0] / src_size[0], appsink_size[1] / src_size[1])
-        scale = tuple(int(x * scale) for x in src_size)
-        scale_caps = "video/x-raw,width={width},height={height}".format(
-            width=scale[0], height=scale[1]
-        )
-        PIPELINE += """ ! decodebin ! queue ! videoconvert ! videoscale
+        scale_caps = get_scale_caps(src_size, appsink_size)
+        PIPELINE += """ ! decodebin ! {queue} ! videoconvert ! videoscale
         ! {scale_caps} ! videobox name=box autocrop=true ! {sink_caps} ! {sink_element}
         """
     elif coral:
         if "mt8167" in coral:
-            PIPELINE += """ ! decodebin ! queue ! v4l2convert ! {scale_caps} !
+            PIPELINE += """ ! decodebin ! {queue} ! v4l2convert ! {scale_caps} !
               glupload ! glcolorconvert ! video/x-raw(memory:GLMemory),format=RGBA !
               tee name=t
-                t. ! queue ! glfilterbin filter=glbox name=glbox ! queue ! {sink_caps} ! {sink_element}
-                t. ! queue ! glsvgoverlay name=gloverlay sync=false ! glimagesink fullscreen=true
+                t. ! {queue} ! glfilterbin filter=glbox name=glbox ! {queue} ! {sink_caps} ! {sink_element}
+                t. ! {queue} ! glsvgoverlay name=gloverlay sync=false ! glimagesink fullscreen=true
                      qos=false sync=false
             """
             scale_caps = "video/x-raw,format=BGRA,width={w},height={h}".format(
@@ -293,16 +395,12 @@ def run_pipeline(
             )
         else:
             PIPELINE += """ ! decodebin ! glupload ! tee name=t
-                t. ! queue ! glfilterbin filter=glbox name=glbox ! {sink_caps} ! {sink_element}
-                t. ! queue ! glsvgoverlaysink name=overlaysink
+                t. ! {queue} ! glfilterbin filter=glbox name=glbox ! {sink_caps} ! {sink_element}
+                t. ! {queue} ! glsvgoverlaysink name=overlaysink
             """
             scale_caps = None
     else:
-        scale = min(appsink_size[0] / src_size[0], appsink_size[1] / src_size[1])
-        scale = tuple(int(x * scale) for x in src_size)
-        scale_caps = "video/x-raw,width={width},height={height}".format(
-            width=scale[0], height=scale[1]
-        )
+        scale_caps = get_scale_caps(src_size, appsink_size)
         PIPELINE += """ ! tee name=t
             t. ! {leaky_q} ! videoconvert ! videoscale ! {scale_caps} ! videobox name=box autocrop=true
                ! {sink_caps} ! {sink_element}
@@ -313,11 +411,13 @@ def run_pipeline(
     SINK_ELEMENT = "appsink name=appsink emit-signals=true max-buffers=1 drop=true"
     SINK_CAPS = "video/x-raw,format=RGB,width={width},height={height}"
     LEAKY_Q = "queue max-size-buffers=1 leaky=downstream"
+    QUEUE = get_queue(bounded)
 
     src_caps = SRC_CAPS.format(width=src_size[0], height=src_size[1])
     sink_caps = SINK_CAPS.format(width=appsink_size[0], height=appsink_size[1])
     pipeline = PIPELINE.format(
         leaky_q=LEAKY_Q,
+        queue=QUEUE,
         src_caps=src_caps,
         sink_caps=sink_caps,
         sink_element=SINK_ELEMENT,
@@ -326,5 +426,5 @@ def run_pipeline(
 
     print("Gstreamer pipeline:\n", pipeline)
 
-    pipeline = GstPipeline(pipeline, user_function, src_size)
+    pipeline = GstPipeline(pipeline, user_function, src_size, profiler)
     pipeline.run()
@@ -0,0 +1,120 @@
+"""Runtime-toggleable scoped timers for the inference thread.
+
+Timings are aggregated per call stack and written in collapsed-stack format
+(one "frame;frame;frame value" line per stack, value = self time in
+microseconds), which flamegraph.pl and speedscope read directly.
+"""
+import collections
+import contextlib
+import datetime
+import os
+import threading
+import time
+
+DEFAULT_WINDOW = 10.0
+
+_NULL_SECTION = contextlib.nullcontext()
+
+
+class _Section:
+    __slots__ = ("profiler", "name", "start", "children")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.children = 0.0
+
+    def __enter__(self):
+        self.profiler._stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._exit(self, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    """Scoped timers that are only active for a fixed window after start().
+
+    start(), stop() and toggle() may be called from any thread (signal
+    handler, MQTT callback). They only queue a request; the inference thread
+    applies it in tick() between two frames, so a window never begins or ends
+    in the middle of a frame. While disabled, section() costs one attribute
+    lookup and returns a shared no-op context manager.
+    """
+
+    def __init__(self, output_dir, window=DEFAULT_WINDOW):
+        self.output_dir = output_dir
+        self.window = window
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._request = None
+        self._deadline = 0.0
+        self._stack = []
+        self._stacks = collections.Counter()
+
+    def start(self, window=None):
+        with self._lock:
+            self._request = window if window else self.window
+
+    def stop(self):
+        with self._lock:
+            self._request = 0
+
+    def toggle(self):
+        with self._lock:
+            if self.enabled or self._request:
+                self._request = 0
+            else:
+                self._request = self.window
+
+    def section(self, name):
+        if not self.enabled:
+            return _NULL_SECTION
+        return _Section(self, name)
+
+    def tick(self):
+        """Applies pending requests and flushes an expired window."""
+        if self._request is not None:
+            with self._lock:
+                window, self._request = self._request, None
+            if window > 0:
+                if self.enabled:
+                    # A new start request ends the running window early.
+                    print("Restarting profiling window")
+                    self._flush()
+                print("Profiling for {:.1f} s".format(window))
+                self._stacks.clear()
+                self._deadline = time.monotonic() + window
+                self.enabled = True
+            elif window <= 0 and self.enabled:
+                self._flush()
+        elif self.enabled and time.monotonic() >= self._deadline:
+            self._flush()
+
+    def finish(self):
+        """Writes a window that is still running, call once no frames follow."""
+        if self.enabled:
+            self._flush()
+
+    def _exit(self, section, elapsed):
+        stack = self._stack
+        key = ";".join(s.name for s in stack)
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+        self._stacks[key] += elapsed - section.children
+
+    def _flush(self):
+        self.enabled = False
+        name = datetime.datetime.now().strftime("profile-%Y%m%d-%H%M%S-%f.folded")
+        path = os.path.join(self.output_dir, name)
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                for key, seconds in sorted(self._stacks.items()):
+                    f.write("{} {}\n".format(key, max(0, round(seconds * 1e6))))
+            print("Profile written to {}".format(path))
+        except OSError as e:
+            print("Could not write profile {}: {}".format(path, e))
+        self._stacks.clear()
@@ -0,0 +1,299 @@
+"""Offline reprocessing of recorded footage.
+
+Runs the detection and slot logic over video files and image folders on a
+process pool and writes an occupancy timeline. Videos are split into
+segments of --segment seconds so a single long recording is spread over all
+workers as well. Each worker opens its own interpreter. With Edge TPUs
+present, worker i uses Edge TPU i and there are at most as many workers as
+TPUs; --device cpu (or no Edge TPU) runs --cpu_model on every worker
+instead. Both are never mixed within one run.
+
+    python3 reprocess.py recordings/*.mp4 --output timeline.jsonl
+    python3 reprocess.py frames/ --threshold 0.6 --format npz --output timeline.npz
+
+Every record holds the device and model that scored it, the source (video
+file or image folder), the offset
+(seconds into the video, or the index of the image within its sorted
+folder), the next free position, the number of cups in the basket and one
+occupancy flag per reference slot. The npz output stores these as columns,
+with the sources in a separate table referenced by source_id.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import detect
+import gstreamer
+
+from PIL import Image
+
+from pycoral.adapters.common import input_size
+from pycoral.adapters.detect import get_objects
+from pycoral.utils.edgetpu import list_edge_tpus
+from pycoral.utils.edgetpu import make_interpreter
+from pycoral.utils.edgetpu import run_inference
+
+# Set in every worker by init_worker.
+_worker = {}
+
+
+def make_worker_interpreter(index, device, model):
+    """Returns the interpreter and the name of the device it runs on."""
+    if device == "edgetpu":
+        interpreter = make_interpreter(model, device=":{}".format(index))
+        return interpreter, "edgetpu:{}".format(index)
+
+    # Only needed to run on the CPU.
+    import tflite_runtime.interpreter as tflite
+
+    return tflite.Interpreter(model_path=model, num_threads=1), "cpu"
+
+
+def init_worker(counter, device, model, args, cup_bbox):
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    interpreter, device = make_worker_interpreter(index, device, model)
+    print("Worker {} uses {} ({})".format(index, device, model))
+    interpreter.allocate_tensors()
+    inference_size = input_size(interpreter)
+    _worker.update(
+        interpreter=interpreter,
+        device=device,
+        inference_size=inference_size,
+        input_tensor=np.empty(inference_size[::-1] + (3,), dtype=np.uint8),
+        cup_bbox=cup_bbox,
+        threshold=args.threshold,
+        top_k=args.top_k,
+    )
+
+
+def detect_slots(input_tensor):
+    interpreter = _worker["interpreter"]
+    run_inference(interpreter, input_tensor)
+    objs = get_objects(interpreter, _worker["threshold"])[: _worker["top_k"]]
+    positions, count = detect.get_cup_positions(objs, _worker["cup_bbox"])
+    occupied = [False] * len(_worker["cup_bbox"])
+    for pos in positions:
+        if pos >= 0:
+            occupied[pos] = True
+    return detect.next_cup_position(positions), count, occupied
+
+
+def run_frames(source, frames):
+    """
+    Runs detect_slots on (offset, input tensor) pairs and returns the task's
+    timeline as numpy columns, so only compact arrays leave the worker.
+    """
+    offsets, positions, counts, occupied = [], [], [], []
+    for offset, input_tensor in frames:
+        position, count, slots = detect_slots(input_tensor)
+        offsets.append(offset)
+        positions.append(position)
+        counts.append(count)
+        occupied.append(slots)
+    return {
+        "source": source,
+        "device": _worker["device"],
+        "offset": np.array(offsets, dtype=np.float64),
+        "position": np.array(positions, dtype=np.int8),
+        "count": np.array(counts, dtype=np.int16),
+        "occupied": np.array(occupied, dtype=bool).reshape(
+            len(offsets), len(_worker["cup_bbox"])
+        ),
+    }
+
+
+def decode_video(source, start, stop):
+    frames = gstreamer.decode_frames(
+        source, (detect.CAM_W, detect.CAM_H), _worker["inference_size"], start, stop
+    )
+    for pts, gstbuffer, _ in frames:
+        # Segment boundaries are clipped by the seek, this only guards
+        # against a frame being reported by two neighbouring segments.
+        if stop is not None and pts >= stop:
+            break
+        yield pts / 1e9, gstbuffer
+
+
+def load_images(paths, first_index):
+    for index, path in enumerate(paths, start=first_index):
+        with Image.open(path) as image:
+            detect.letterbox(image, _worker["inference_size"], _worker["input_tensor"])
+        yield float(index), _worker["input_tensor"]
+
+
+def process_video(source, start, stop):
+    return run_frames(source, decode_video(source, start, stop))
+
+
+def process_images(source, paths, first_index):
+    return run_frames(source, load_images(paths, first_index))
+
+
+def process_task(task):
+    kind, *params = task
+    if kind == "video":
+        return process_video(*params)
+    return process_images(*params)
+
+
+def make_tasks(inputs, segment, chunk):
+    tasks = []
+    for source in inputs:
+        if os.path.isdir(source):
+            paths = detect.list_images(source)
+            for i in range(0, len(paths), chunk):
+                tasks.append(("images", source, paths[i : i + chunk], i))
+        elif source.lower().endswith(detect.IMAGE_EXTENSIONS):
+            tasks.append(("images", source, [source], 0))
+        else:
+            duration = gstreamer.get_video_duration(source)
+            step = int(segment * 1e9)
+            if duration is None or step <= 0:
+                tasks.append(("video", source, None, None))
+                continue
+            for start in range(0, duration, step):
+                tasks.append(("video", source, start, min(start + step, duration)))
+    return tasks
+
+
+def write_jsonl(f, columns, model):
+    for offset, position, count, occupied in zip(
+        columns["offset"], columns["position"], columns["count"], columns["occupied"]
+    ):
+        record = {
+            "device": columns["device"],
+            "model": model,
+            "source": columns["source"],
+            "offset": round(float(offset), 3),
+            "position": int(position),
+            "count": int(count),
+            "occupied": occupied.tolist(),
+        }
+        f.write(json.dumps(record) + "\n")
+
+
+def write_npz(path, results, num_slots, model):
+    """Concatenates the per-task columns, sources and devices become tables."""
+    sources, devices = {}, {}
+    source_ids = [np.zeros(0, dtype=np.uint32)]
+    device_ids = [np.zeros(0, dtype=np.uint8)]
+    offsets = [np.zeros(0, dtype=np.float64)]
+    positions = [np.zeros(0, dtype=np.int8)]
+    counts = [np.zeros(0, dtype=np.int16)]
+    occupied = [np.zeros((0, num_slots), dtype=bool)]
+    for columns in results:
+        source_id = sources.setdefault(columns["source"], len(sources))
+        device_id = devices.setdefault(columns["device"], len(devices))
+        n = len(columns["offset"])
+        source_ids.append(np.full(n, source_id, dtype=np.uint32))
+        device_ids.append(np.full(n, device_id, dtype=np.uint8))
+        offsets.append(columns["offset"])
+        positions.append(columns["position"])
+        counts.append(columns["count"])
+        occupied.append(columns["occupied"])
+    offsets = np.concatenate(offsets)
+    np.savez_compressed(
+        path,
+        model=np.array(model),
+        devices=np.array(list(devices), dtype=str),
+        device_id=np.concatenate(device_ids),
+        sources=np.array(list(sources), dtype=str),
+        source_id=np.concatenate(source_ids),
+        offset=offsets,
+        position=np.concatenate(positions),
+        count=np.concatenate(counts),
+        occupied=np.concatenate(occupied),
+    )
+    return len(offsets)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs="+", help="video files or image folders")
+    parser.add_argument(
+        "--model",
+        help=".tflite model path",
+        default=os.path.join(detect.DEFAULT_MODEL_DIR, detect.DEFAULT_MODEL),
+    )
+    parser.add_argument(
+        "--device",
+        default="auto",
+        choices=["auto", "edgetpu", "cpu"],
+        help="auto uses the Edge TPUs if there are any, the CPU otherwise",
+    )
+    parser.add_argument(
+        "--cpu_model",
+        help="non-Edge TPU .tflite model, required to run on the CPU",
+    )
+    parser.add_argument("--top_k", type=int, default=20)
+    parser.add_argument(
+        "--threshold", type=float, default=0.55, help="classifier score threshold"
+    )
+    parser.add_argument(
+        "--positions", default=detect.FILE_PATH, help="reference positions file"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--segment", type=float, default=60.0, help="seconds of video per task"
+    )
+    parser.add_argument("--chunk", type=int, default=200, help="images per task")
+    parser.add_argument("--format", default="jsonl", choices=["jsonl", "npz"])
+    parser.add_argument("--output", help="default: timeline.jsonl or timeline.npz")
+    args = parser.parse_args()
+    if not args.output:
+        args.output = "timeline." + args.format
+    if not os.path.isfile(args.positions):
+        parser.error("reference positions file {} not found".format(args.positions))
+    cup_bbox = detect.get_reference_positions(args, args.positions)[0]
+
+    workers = args.workers
+    tpus = len(list_edge_tpus())
+    device = args.device
+    if device == "auto":
+        device = "edgetpu" if tpus else "cpu"
+    if device == "edgetpu":
+        if tpus == 0:
+            parser.error("no Edge TPU found")
+        if workers > tpus:
+            print("One worker per Edge TPU, using {} worker(s)".format(tpus))
+            workers = tpus
+        model = args.model
+    else:
+        if not args.cpu_model:
+            parser.error("--cpu_model is required to run on the CPU")
+        model = args.cpu_model
+
+    tasks = make_tasks(args.inputs, args.segment, args.chunk)
+    print("Processing {} task(s) with {} worker(s)".format(len(tasks), workers))
+
+    # spawn, so no worker inherits the GStreamer or Edge TPU state of this process.
+    context = multiprocessing.get_context("spawn")
+    counter = context.Value("i", 0)
+    start = time.monotonic()
+    frames = 0
+    initargs = (counter, device, model, args, cup_bbox)
+    with context.Pool(workers, init_worker, initargs) as pool:
+        results = pool.imap(process_task, tasks)
+        if args.format == "jsonl":
+            with open(args.output, "w", encoding="utf-8") as f:
+                for columns in results:
+                    frames += len(columns["offset"])
+                    write_jsonl(f, columns, model)
+        else:
+            frames = write_npz(args.output, results, len(cup_bbox), model)
+
+    elapsed = time.monotonic() - start
+    print(
+        "Wrote {} frames to {} in {:.1f} s ({:.1f} frames/s)".format(
+            frames, args.output, elapsed, frames / elapsed
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
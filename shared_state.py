@@ -0,0 +1,154 @@
+"""Latest slot state in shared memory for consumers on the same board.
+
+detect.py writes every result into a small memory-mapped file (by default
+in /dev/shm) guarded by a seqlock: the writer makes the sequence number odd,
+writes the payload and makes it even again. Readers never take a lock, they
+copy the payload and retry if the sequence changed or was odd meanwhile.
+
+Python gives no memory barriers around mmap stores, and on aarch64 another
+core may observe them out of order. The writer therefore also stores the
+sequence number after the payload together with a CRC32 over sequence and
+payload; a reader only accepts a copy in which both sequence numbers and
+the trailer agree and the checksum matches.
+
+    from shared_state import StateReader
+
+    reader = StateReader()  # the file may not exist yet
+    state = reader.read()  # None until detect.py has written a result
+    if state:
+        print(state.timestamp, state.position, state.count, state.occupied)
+
+Layout (little endian):
+    0   4s  magic b"CNVS"
+    4   I   layout version
+    8   Q   sequence, odd while a write is in progress
+    16  d   timestamp of the result (time.time())
+    24  i   next free position (-1 if none), as published on TOPIC
+    28  i   number of cups in the basket
+    32  i   number of reference slots
+    36  I   occupancy bitmask, bit i set if slot i holds a cup
+    40  Q   sequence again, written after the payload
+    48  I   CRC32 of the sequence and payload bytes
+"""
+import collections
+import mmap
+import os
+import struct
+import time
+import zlib
+
+DEFAULT_PATH = "/dev/shm/cinito_vision_state"
+MAGIC = b"CNVS"
+VERSION = 1
+MAX_SLOTS = 32
+
+_HEADER = struct.Struct("<4sI")
+_SEQ = struct.Struct("<Q")
+_PAYLOAD = struct.Struct("<diiiI")
+_TRAILER = struct.Struct("<QI")
+_SEQ_OFFSET = _HEADER.size
+_PAYLOAD_OFFSET = _SEQ_OFFSET + _SEQ.size
+_TRAILER_OFFSET = _PAYLOAD_OFFSET + _PAYLOAD.size
+SIZE = _TRAILER_OFFSET + _TRAILER.size
+
+State = collections.namedtuple(
+    "State", ["sequence", "timestamp", "position", "count", "occupied"]
+)
+
+
+class StateWriter:
+    def __init__(self, path=DEFAULT_PATH, num_slots=16):
+        if not 0 <= num_slots <= MAX_SLOTS:
+            raise ValueError("At most {} slots are supported".format(MAX_SLOTS))
+        self.num_slots = num_slots
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SIZE)
+            self._map = mmap.mmap(fd, SIZE)
+        finally:
+            os.close(fd)
+        # Forget the result of a previous run, read() returns None until the
+        # first write().
+        self._seq = 0
+        self._map[_SEQ_OFFSET:SIZE] = bytes(SIZE - _SEQ_OFFSET)
+        _HEADER.pack_into(self._map, 0, MAGIC, VERSION)
+
+    def write(self, position, count, occupied=(), timestamp=None):
+        """occupied are the slot indices holding a cup, negative ones are ignored."""
+        mask = 0
+        for slot in occupied:
+            if 0 <= slot < self.num_slots:
+                mask |= 1 << slot
+        if timestamp is None:
+            timestamp = time.time()
+        self._commit(_PAYLOAD.pack(timestamp, position, count, self.num_slots, mask))
+
+    def _commit(self, payload):
+        seq = self._seq + 2
+        crc = zlib.crc32(_SEQ.pack(seq) + payload)
+        _SEQ.pack_into(self._map, _SEQ_OFFSET, self._seq + 1)
+        self._map[_PAYLOAD_OFFSET:_TRAILER_OFFSET] = payload
+        _TRAILER.pack_into(self._map, _TRAILER_OFFSET, seq, crc)
+        _SEQ.pack_into(self._map, _SEQ_OFFSET, seq)
+        self._seq = seq
+
+    def close(self):
+        self._map.close()
+
+
+class StateReader:
+    """
+    The file is mapped on the first read() that finds it at its full size,
+    so a reader may be created before detect.py has started.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._map = None
+
+    def _open(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            # The writer creates the file before it grows it to SIZE.
+            if os.fstat(fd).st_size < SIZE:
+                return False
+            self._map = mmap.mmap(fd, SIZE, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        return True
+
+    def read(self, retries=10000):
+        """
+        Returns the newest State, or None if nothing has been written yet.
+        occupied is a tuple of booleans, one per reference slot.
+        """
+        if self._map is None and not self._open():
+            return None
+        m = self._map
+        for _ in range(retries):
+            seq = _SEQ.unpack_from(m, _SEQ_OFFSET)[0]
+            if seq & 1:
+                continue
+            magic, version = _HEADER.unpack_from(m, 0)
+            payload = m[_PAYLOAD_OFFSET:_TRAILER_OFFSET]
+            trailer_seq, crc = _TRAILER.unpack_from(m, _TRAILER_OFFSET)
+            if _SEQ.unpack_from(m, _SEQ_OFFSET)[0] != seq:
+                continue
+            if seq == 0:
+                return None
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("Unknown state layout {!r} v{}".format(magic, version))
+            if trailer_seq != seq or zlib.crc32(_SEQ.pack(seq) + payload) != crc:
+                continue
+            timestamp, position, count, num_slots, mask = _PAYLOAD.unpack(payload)
+            occupied = tuple(bool(mask >> i & 1) for i in range(num_slots))
+            return State(seq // 2, timestamp, position, count, occupied)
+        raise RuntimeError("No consistent state after {} attempts".format(retries))
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
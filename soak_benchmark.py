@@ -0,0 +1,211 @@
+"""Soak benchmark for the per-frame detection path.
+
+Replays footage through the same per-frame work as detect.py (inference,
+slot assignment, shared-memory state, publishing, overlay generation and
+the profiler sections, which stay off as in a default run) for hours of
+simulated time and reports RSS growth and the net number of allocated
+Python blocks per frame. Videos are decoded in a loop by GStreamer, with
+the queue limits of --bounded_memory if given. The MQTT client is never
+connected, which is the broker outage case.
+
+    python3 soak_benchmark.py --footage /path/to/recording.mp4 --hours 24
+    python3 soak_benchmark.py --footage /path/to/frames --hours 24 --bounded_memory
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+from PIL import Image
+
+import detect
+import gstreamer
+
+from profiling import Profiler
+from pycoral.adapters.common import input_size
+from pycoral.adapters.detect import get_objects
+from pycoral.utils.dataset import read_label_file
+from pycoral.utils.edgetpu import make_interpreter
+from pycoral.utils.edgetpu import run_inference
+from shared_state import MAX_SLOTS, StateWriter
+
+
+def rss_kb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def replay_video(path, inference_size, bounded):
+    """Yields (Gst.Buffer, inference box), restarting the video at its end."""
+    while True:
+        decoded = False
+        for _, gstbuffer, box in gstreamer.decode_frames(
+            path, (detect.CAM_W, detect.CAM_H), inference_size, bounded=bounded
+        ):
+            decoded = True
+            yield gstbuffer, box
+        if not decoded:
+            raise RuntimeError("No frames decoded from {}".format(path))
+
+
+def replay_images(names, inference_size):
+    """
+    Yields (input tensor, inference box) for the images in a loop, a single
+    black frame without images. Every frame is copied into one input array,
+    standing in for the appsink buffer.
+    """
+    w, h = inference_size
+    frames = np.zeros((max(len(names), 1), h, w, 3), dtype=np.uint8)
+    box = (0, 0, w, h)
+    for i, name in enumerate(names):
+        with Image.open(name) as image:
+            _, box = detect.letterbox(image, inference_size, frames[i])
+    input_tensor = np.empty_like(frames[0])
+    while True:
+        for frame in frames:
+            np.copyto(input_tensor, frame)
+            yield input_tensor, box
+
+
+def replay_footage(path, inference_size, max_frames, bounded):
+    if path is None:
+        return replay_images([], inference_size)
+    if os.path.isdir(path):
+        names = detect.list_images(path)[:max_frames]
+        return replay_images(names, inference_size)
+    if path.lower().endswith(detect.IMAGE_EXTENSIONS):
+        return replay_images([path], inference_size)
+    return replay_video(path, inference_size, bounded)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model",
+        help=".tflite model path",
+        default=os.path.join(detect.DEFAULT_MODEL_DIR, detect.DEFAULT_MODEL),
+    )
+    parser.add_argument(
+        "--labels",
+        help="label file path",
+        default=os.path.join(detect.DEFAULT_MODEL_DIR, detect.DEFAULT_LABELS),
+    )
+    parser.add_argument("--top_k", type=int, default=20)
+    parser.add_argument("--threshold", type=float, default=0.55)
+    parser.add_argument(
+        "--positions",
+        default=detect.FILE_PATH,
+        help="reference positions file",
+    )
+    parser.add_argument(
+        "--footage",
+        help="video, image or folder of images to replay (default: black frame)",
+    )
+    parser.add_argument(
+        "--max_frames", type=int, default=100, help="images loaded from a folder"
+    )
+    parser.add_argument("--hours", type=float, default=24.0, help="simulated hours")
+    parser.add_argument(
+        "--frame_interval",
+        type=float,
+        default=5.0,
+        help="simulated seconds per frame (the live callback sleeps 5 s)",
+    )
+    parser.add_argument("--report_every", type=int, default=1000)
+    parser.add_argument("--bounded_memory", action="store_true")
+    args = parser.parse_args()
+    total = int(args.hours * 3600 / args.frame_interval)
+    if total < 1:
+        parser.error("--hours must cover at least one --frame_interval")
+
+    interpreter = make_interpreter(args.model)
+    interpreter.allocate_tensors()
+    labels = read_label_file(args.labels)
+    inference_size = input_size(interpreter)
+    cup_bbox = detect.get_reference_positions(args, args.positions)[0] or []
+    footage = replay_footage(
+        args.footage, inference_size, args.max_frames, args.bounded_memory
+    )
+    src_size = (detect.CAM_W, detect.CAM_H)
+
+    client = mqtt.Client()
+    if args.bounded_memory:
+        detect.limit_queues(client)
+    # Off, as in a default detect.py run, so only the section checks remain.
+    profiler = Profiler(tempfile.gettempdir())
+    state_path = os.path.join(
+        "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+        "cinito_vision_state_soak",
+    )
+    state_writer = StateWriter(state_path, min(len(cup_bbox), MAX_SLOTS))
+
+    print(
+        "Replaying {} frames ({:.1f} h simulated, bounded memory: {})".format(
+            total, args.hours, args.bounded_memory
+        )
+    )
+
+    base_rss = base_blocks = None
+    prev_n, prev_blocks = 0, sys.getallocatedblocks()
+    start = time.monotonic()
+    for n, (input_tensor, inference_box) in zip(range(1, total + 1), footage):
+        profiler.tick()
+        with profiler.section("inference_loop"), profiler.section("user_callback"):
+            with profiler.section("run_inference"):
+                run_inference(interpreter, input_tensor)
+            with profiler.section("get_objects"):
+                objs = get_objects(interpreter, args.threshold)[: args.top_k]
+            with profiler.section("slot_assignment"):
+                positions, count = detect.get_cup_positions(objs, cup_bbox)
+                position = detect.next_cup_position(positions)
+            with profiler.section("shared_state"):
+                state_writer.write(position, count, positions)
+            with profiler.section("publish"):
+                detect.publish_result(client, position, count, args.bounded_memory)
+            with profiler.section("generate_svg"):
+                detect.generate_svg(src_size, inference_box, objs, labels, ["soak"])
+
+        if n % args.report_every == 0 or n == total:
+            rss, blocks = rss_kb(), sys.getallocatedblocks()
+            if base_rss is None:
+                # The first interval includes warm-up allocations.
+                base_rss, base_blocks = rss, blocks
+            print(
+                "frame {:>8} | {:7.2f} h | RSS {:8.1f} MB ({:+.1f}) | "
+                "blocks/frame {:+.3f}".format(
+                    n,
+                    n * args.frame_interval / 3600,
+                    rss / 1024,
+                    (rss - base_rss) / 1024,
+                    (blocks - prev_blocks) / (n - prev_n),
+                )
+            )
+            prev_n, prev_blocks = n, blocks
+
+    elapsed = time.monotonic() - start
+    footage.close()
+    state_writer.close()
+    os.remove(state_path)
+    frames_measured = max(total - min(args.report_every, total), 1)
+    print("Frames/s: {:.1f}".format(total / elapsed))
+    print(
+        "RSS growth after warm-up: {:+.1f} MB ({:+.3f} kB/frame)".format(
+            (rss - base_rss) / 1024, (rss - base_rss) / frames_measured
+        )
+    )
+    print(
+        "Allocated blocks after warm-up: {:+d} ({:+.3f}/frame)".format(
+            blocks - base_blocks, (blocks - base_blocks) / frames_measured
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Latency benchmark for the shared-memory state endpoint.
+
+A writer process publishes results at a fixed rate while this process polls
+with StateReader. Reported are the cost of a single read() and the time from
+write() until the reader sees the new sequence number. The writer stamps
+results with time.monotonic(), which is shared by all processes on Linux.
+
+    python3 state_latency_benchmark.py --updates 10000 --interval 0.001
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from shared_state import StateReader, StateWriter
+
+
+def write_states(path, updates, interval, ready):
+    writer = StateWriter(path)
+    ready.set()
+    for n in range(updates):
+        time.sleep(interval)
+        writer.write(n % 16, n % 17, range(n % 17), timestamp=time.monotonic())
+    writer.close()
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return "p50 {:7.1f} us | p99 {:7.1f} us | max {:7.1f} us".format(
+        samples[len(samples) // 2] * 1e6,
+        samples[int(len(samples) * 0.99)] * 1e6,
+        samples[-1] * 1e6,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--interval", type=float, default=0.001, help="seconds")
+    parser.add_argument("--reads", type=int, default=100000)
+    args = parser.parse_args()
+
+    path = os.path.join(
+        "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+        "cinito_vision_state_bench",
+    )
+    ready = multiprocessing.Event()
+    writer = multiprocessing.Process(
+        target=write_states, args=(path, args.updates, args.interval, ready)
+    )
+    writer.start()
+    ready.wait()
+    reader = StateReader(path)
+
+    read_costs = []
+    for _ in range(args.reads):
+        start = time.perf_counter()
+        reader.read()
+        read_costs.append(time.perf_counter() - start)
+
+    latencies = []
+    last = None
+    while writer.is_alive():
+        state = reader.read()
+        if state and state.sequence != last:
+            latencies.append(time.monotonic() - state.timestamp)
+            last = state.sequence
+    writer.join()
+    reader.close()
+    os.remove(path)
+
+    print("read():        {}".format(percentiles(read_costs)))
+    if latencies:
+        print("write->read:   {}".format(percentiles(latencies)))
+        print(
+            "Seen {} of {} updates while polling".format(len(latencies), args.updates)
+        )
+
+
+if __name__ == "__main__":
+    main()